@@ -8,24 +8,49 @@
 #    validate_filter_ip.py 1.0 2020-06-30 by Brice Cox, bcox@arista.com
 
 import argparse
+import array
+import binascii
+import collections
+import ipaddress
 import logging
 import os
 import platform
 import re
+import select
 import signal
 import socket
-import subprocess
+import struct
 import sys
 import syslog
 import time
 from jsonrpclib import Server
 
 # Global configuration settings
-# logStr is a formatting pattern used by str.format() to align outputs
-logStr = '{:27} {}'
+# logStr is a %-style pattern handed to logging to align outputs, the message
+# is only formatted when the log level lets it through
+logStr = '%-27s %s'
 # syslogFormat can be customised to match syslog preference
 syslogFormat = '%VALIDATE_FILTER_IP-5-LOG'
 prefix_list_name = 'SCRIPTED_ROUTE_FILTER'
+# apiSocket is where EOS serves the eAPI (management api http-commands)
+apiSocket = '/var/run/command-api.sock'
+# icmpPayload is carried in every echo request
+icmpPayload = b'validate_filter_ip'
+# maxInFlight caps the echo requests awaiting a reply, so a long list of hosts
+# cannot overflow the socket receive buffer. Past maxInFlight hosts a poll can
+# take about ceil(unanswered / maxInFlight) * timeout, which stretches both the
+# interval between polls and the time to declare a host dead
+maxInFlight = 64
+# icmpHeader is the echo request/reply header: type, code, checksum, id, seq
+icmpHeader = struct.Struct('!BBHHH')
+
+# eAPI handle shared by every prefix-list operation, never closed so the
+# connection to the unix socket is kept alive
+_switch_api = None
+# filtered state last seen for each (net31, prefix_list_name)
+_filter_cache = {}
+# MACOS hands the IP header back along with the ICMP reply, checked once
+_isDarwin = platform.system() == 'Darwin'
 
 def setLogging(args):
     # The log level sets the amount of information displayed (error<info<debug)
@@ -80,282 +105,374 @@ def argsDisplay(args):
     # For debug purpose or curiosity
     logging.info('')
     logging.info('########### Your settings: ###########')
-    logging.debug(logStr.format('Args are:', args))
-    logging.info(logStr.format('Verbose:', args.verbose))
-    logging.info(logStr.format('VeryVerbose:', args.veryverbose))
-    logging.info(logStr.format('Interval:', args.interval))
-    logging.info(logStr.format('Timeout:', args.timeout))
-    logging.info(logStr.format('Mode:', args.mode))
-    logging.info(logStr.format('Source IP:', args.source))
-    logging.info(logStr.format('Dampening amount:', args.dampening))
-    logging.info(logStr.format('Target Host:', args.host))
+    logging.debug(logStr, 'Args are:', args)
+    logging.info(logStr, 'Verbose:', args.verbose)
+    logging.info(logStr, 'VeryVerbose:', args.veryverbose)
+    logging.info(logStr, 'Interval:', args.interval)
+    logging.info(logStr, 'Timeout:', args.timeout)
+    logging.info(logStr, 'Mode:', args.mode)
+    logging.info(logStr, 'Source IP:', args.source)
+    logging.info(logStr, 'Dampening amount:', args.dampening)
+    logging.info(logStr, 'Target Host:', args.host)
     logging.info('#######################################')
     logging.info('')
 
 
-def checkOS():
-    # Different OS have diferring PING options. This fuction standardises
-    os = platform.system()
-    osSettings = {}
-    timeUnit = 1
-    sourceSetting = '-I'
-    if os == 'Linux':
-        # On EOS Linux kernel timeout is in second and IP source as '-I'
-        timeUnit = 1
-        sourceSetting = '-I'
-    elif os == 'Darwin':
-        # On MACOS timeout is in msec (want it in sec) and IP source as '-S'
-        timeUnit = 1000
-        sourceSetting = '-S'
-    else:
-        logging.error('Error - Unsupported OS')
-    osSettings['timeUnit'] = timeUnit
-    osSettings['sourceSetting'] = sourceSetting
-    return osSettings
+def icmpChecksum(data):
+    # 16 bit one's complement of the one's complement sum (RFC 1071). The data
+    # is read as an array of 16 bit words so the sum runs in C, not per byte
+    if len(data) % 2:
+        data += b'\x00'
+    words = array.array('H', data)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    total = sum(words)
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
 
 
 class checkICMP:
-    # Verifies a reachability by ICMP and records the response latency
-    def __init__(self, osSettings, host):
-
-        self.timeUnit = osSettings['timeUnit']
-        self.sourceSetting = osSettings['sourceSetting']
-        self.host = host
-
-    def getLatency(self, output):
-        # Must first get an output to parse, used after/with isAlive()
-        outputLines = output.split('\n')
-        lastNonEmpty = [i for i in outputLines if i][-1]
-        logging.debug(logStr.format('Ping result:', lastNonEmpty))
-        timingData = lastNonEmpty.split('=')[1]
-        timingStats = timingData.split('/')
-        pingAvg = timingStats[1]
-        return pingAvg + ' ms'
+    # Verifies the reachability of every host by ICMP from a single socket and
+    # records the response latencies. Per host data is held in lists that
+    # share the indexing of self.hosts.
+    __slots__ = ('hosts', 'addresses', 'index', 'sent', 'ident', 'seq',
+                 'partialSum', 'sock', 'ipHeader')
+
+    def __init__(self, hosts):
+
+        self.hosts = hosts
+        self.addresses = [(host, 0) for host in hosts]
+        self.index = dict((host, i) for i, host in enumerate(hosts))
+        self.sent = [0.0] * len(hosts)
+        self.ident = os.getpid() & 0xffff
+        self.seq = 0
+        # Only the sequence number changes between echo requests, so the sum
+        # of everything else is worked out once and seq is added per probe
+        self.partialSum = ~icmpChecksum(
+            icmpHeader.pack(8, 0, 0, self.ident, 0) + icmpPayload) & 0xffff
+        # ICMP socket, opened once and reused for every probe. The
+        # unprivileged datagram socket needs the group to be allowed by
+        # net.ipv4.ping_group_range on Linux, else fall back to a raw socket
+        # which needs root (CAP_NET_RAW)
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                      socket.IPPROTO_ICMP)
+            self.ipHeader = _isDarwin
+        except socket.error as error:
+            logging.debug(logStr, 'ICMP datagram socket:', error)
+            try:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                          socket.IPPROTO_ICMP)
+            except socket.error as error:
+                sys.exit("Unable to open an ICMP socket: " + str(error) +
+                         "\n  run as root or allow the group in "
+                         "net.ipv4.ping_group_range")
+            self.ipHeader = True
+        # TTL is set to 1, allowing for directly connected monitoring only
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, 1)
+        if args.source:
+            self.sock.bind((args.source, 0))
+        self.sock.setblocking(False)
 
     def isAlive(self):
-        result = ''
-        output = ''
-        latency = 0
-        pythonVersion = sys.version_info[0]
-        logging.debug(logStr.format('Python version:', pythonVersion))
-
-        src_exists = True if args.source else False
-        command = ['ping'] + \
-                  ['-n'] + \
-                  ['-c 1'] + \
-                  ['-t 1'] + \
-                  ['-W ' + str(args.timeout * self.timeUnit)] + \
-                  [self.sourceSetting + str(args.source)] * src_exists + \
-                  [self.host]
-        logging.debug(logStr.format('The command is:', str(command)))
-
-        # Python 2 compatibility for running on EOS
-        if sys.version_info[0] < 3:
-            proc = subprocess.Popen(command,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            returncode = proc.wait()
-            if returncode == 0:
-                rawOutput = proc.communicate()
-                output = rawOutput[0].decode('ascii')
-                result = True
-            else:
-                error = 'The ICMP check did not succeed'
-                logging.info(error)
-                result = False
-
-        # Python 3
-        if sys.version_info[0] >= 3:
-            proc = subprocess.run(command, capture_output=True)
-            if proc.returncode == 0:
-                output = proc.stdout.decode('ascii')
-                result = True
-            else:
-                # If proc.returncode != 0 it means an error occured.
-                # We get a clean line for the error message
-                error = proc.stderr.decode('ascii').split('\n')[0]
-                if error == '':
-                    error = 'The ICMP check did not succeed'
+        # Returns the alive (True/False) and latency lists, one entry per host
+        alive = [False] * len(self.hosts)
+        latency = [0] * len(self.hosts)
+        # Hex dumps of the packets are only built when they will be logged
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+        self.seq = (self.seq + 1) & 0xffff
+        total = self.partialSum + self.seq
+        checksum = ~((total >> 16) + (total & 0xffff)) & 0xffff
+        packet = icmpHeader.pack(8, 0, checksum, self.ident,
+                                 self.seq) + icmpPayload
+        if debug:
+            logging.debug(logStr, 'Echo request seq:', self.seq)
+
+        # Echo requests go out in bursts of up to maxInFlight, every reply or
+        # timeout frees a slot for the next host until all hosts are checked
+        outstanding = set()
+        sendOrder = collections.deque()
+        nextHost = 0
+        while True:
+            # Drop answered requests and give up on the oldest ones once
+            # their timeout expired
+            now = time.perf_counter()
+            while sendOrder and (sendOrder[0] not in outstanding or
+                                 self.sent[sendOrder[0]] + args.timeout <= now):
+                outstanding.discard(sendOrder.popleft())
+            while nextHost < len(self.hosts) and \
+                    len(outstanding) < maxInFlight:
+                i = nextHost
+                nextHost += 1
+                self.sent[i] = time.perf_counter()
+                try:
+                    self.sock.sendto(packet, self.addresses[i])
+                except socket.error as error:
+                    logging.info('%s: %s', self.hosts[i], error)
+                    continue
+                outstanding.add(i)
+                sendOrder.append(i)
+            if not outstanding:
+                break
+
+            remaining = self.sent[sendOrder[0]] + args.timeout - \
+                time.perf_counter()
+            ready, _, _ = select.select([self.sock], [], [],
+                                        max(remaining, 0))
+            if not ready:
+                continue
+            try:
+                reply, address = self.sock.recvfrom(1024)
+            except socket.error as error:
                 logging.info(error)
-                result = False
-
-        if output:
-            logging.debug(logStr.format('The output is:', output))
-            latency = self.getLatency(output)
-        return result, latency
+                continue
+            received = time.perf_counter()
+            if debug:
+                logging.debug(logStr, 'The reply is:',
+                              binascii.hexlify(reply))
+            offset = (reply[0] & 0x0f) * 4 if self.ipHeader and reply else 0
+            if len(reply) < offset + icmpHeader.size:
+                # Truncated or odd packet, too short to be an echo reply
+                continue
+            # Ignore anything but the echo reply to an outstanding request,
+            # e.g. a late reply to a probe that already timed out
+            replyType, code, checksum, ident, seq = \
+                icmpHeader.unpack_from(reply, offset)
+            if self.ipHeader and ident != self.ident:
+                # Only Linux ping sockets rewrite and demux the identifier,
+                # raw and MACOS sockets see replies to other pings too
+                continue
+            i = self.index.get(address[0])
+            if replyType == 0 and seq == self.seq and i in outstanding:
+                outstanding.remove(i)
+                alive[i] = True
+                latency[i] = (received - self.sent[i]) * 1000
+
+        for i, host in enumerate(self.hosts):
+            if not alive[i]:
+                logging.info('The ICMP check of %s did not succeed', host)
+        return alive, latency
 
 
 class Notice():
     # Sends messages out by Syslog or potentially other future methods
-    def __init__(self):
-        pass
+    __slots__ = ()
 
-    def syslog(self, msg):
+    def __init__(self):
+        # Syslog is opened once and reused by every message
         name = 'validate_filter_ip'
         syslog.openlog(name, 0, syslog.LOG_LOCAL4)
+
+    def syslog(self, msg, *params):
+        # msg and params are merged like a logging call
+        if params:
+            msg = msg % params
         syslog.syslog(syslogFormat + ': Log msg: %s' % msg)
 
-def is_valid_ipv4_address(address):
+def parse_address(address):
+    #validated once at startup, the script only handles IPv4 hosts
     try:
-        socket.inet_pton(socket.AF_INET, address)
-    except AttributeError:  # no inet_pton here, sorry
-        try:
-            socket.inet_aton(address)
-        except socket.error:
-            return False
-        return address.count('.') == 3
-    except socket.error:  # not a valid address
-        return False
-
-    return True
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        sys.exit("address " + address + " does not appear to be valid")
+    if ip.version == 6:
+        sys.exit("IPv6 not currently supported")
+    return ip
 #
 
-def network_s31(address):
-    if ":" in address:
-        exit("IPv6 not currently supported")
-    else:
-        if not is_valid_ipv4_address(address):
-            exit("address " + address + " does not appear to be valid")
-        parts = address.split(".")
-        if (int(parts[3]) % 2 == 1):
-            return parts[0] + '.' + parts[1] + '.' + parts[2] + '.' + str(int(parts[3])-1) + '/31'
-        else:
-            return address + '/31'
+def network_s31(ip):
+    return str(ipaddress.IPv4Network((int(ip) & 0xfffffffe, 31)))
 #
 
 def check_filter(net31, prefix_list_name):
+    #only the script changes the prefix-list, so the last known state is kept
+    key = (net31, prefix_list_name)
+    if key not in _filter_cache:
+        _filter_cache[key] = read_filter(net31, prefix_list_name)
+    return _filter_cache[key]
+#
+
+def read_filter(net31, prefix_list_name):
+    #only used on a cache miss, main() loads every host with load_filters()
     #open api connection
     switch_api = build_connection()
     #read filter
     cmd = 'show ip prefix-list ' + prefix_list_name
     result = switch_api.runCmds(1,[cmd])[0]['ipPrefixLists']
-    switch_api('close')()
-    if result.has_key(prefix_list_name):
-        result = result[prefix_list_name]['ipPrefixEntries']
-        while result:
-            iterate = result.pop()
-            if iterate['prefix'] == net31:
-                logging.debug(logStr.format('network /31 found in:', prefix_list_name))
-                logging.debug(logStr.format('sequence number:', iterate['seqno']))
-                return True, iterate['seqno']
-    else:
-        logging.debug(logStr.format('prefix-list does not exist:', prefix_list_name))
-    return False, 0
+    return find_filter(result, net31, prefix_list_name)
+#
+
+def load_filters(nets, prefix_list_name):
+    #read the prefix-list once and cache the state of every network
+    switch_api = build_connection()
+    cmd = 'show ip prefix-list ' + prefix_list_name
+    result = switch_api.runCmds(1,[cmd])[0]['ipPrefixLists']
+    for net31 in nets:
+        _filter_cache[(net31, prefix_list_name)] = find_filter(
+            result, net31, prefix_list_name)
+#
+
+def find_filter(result, net31, prefix_list_name):
+    #look for the network in the output of show ip prefix-list
+    if prefix_list_name not in result:
+        logging.debug(logStr, 'prefix-list does not exist:', prefix_list_name)
+        return False
+    entries = result[prefix_list_name].get('ipPrefixEntries', [])
+    if not any(e['prefix'] == net31 for e in entries):
+        return False
+    logging.debug(logStr, 'network /31 found in:', prefix_list_name)
+    return True
 #
 
 def add_filter(net31, prefix_list_name):
     #open api connection and add the line to the prefix-list
+    #the prefix-list is read back in the same request to confirm the line
+    #was added
     switch_api = build_connection()
     cmd = [
         'enable',
         'configure',
         'ip prefix-list ' + prefix_list_name + ' permit ' + net31,
-        'end'
+        'end',
+        'show ip prefix-list ' + prefix_list_name
         ]
-    result = switch_api.runCmds(1,cmd)
-    switch_api('close')()
+    result = switch_api.runCmds(1,cmd)[-1]['ipPrefixLists']
+    _filter_cache[(net31, prefix_list_name)] = find_filter(
+        result, net31, prefix_list_name)
 #
 
-def remove_filter(seqno, prefix_list_name):
-    #open api connection and add the line to the prefix-list
+def remove_filter(net31, prefix_list_name):
+    #open api connection and remove the line from the prefix-list
+    #the line is matched by prefix, so no sequence number lookup is needed
     switch_api = build_connection()
     cmd = [
         'enable',
         'configure',
-        'no ip prefix-list ' + prefix_list_name + ' seq ' + str(seqno),
+        'no ip prefix-list ' + prefix_list_name + ' permit ' + net31,
         'end'
         ]
     result = switch_api.runCmds(1,cmd)
-    switch_api('close')()
+    _filter_cache[(net31, prefix_list_name)] = False
+#
+
+def check_and_remove(net31, prefix_list_name):
+    #remove the network from the prefix-list if it is filtered
+    filtered = check_filter(net31, prefix_list_name)
+    if filtered:
+        remove_filter(net31, prefix_list_name)
+    return filtered
 #
 
 def build_connection():
-    ### Build connection to api
-    if os.path.exists('/var/run/command-api.sock'):
-        switch_api = Server( "unix:/var/run/command-api.sock")
-        return switch_api
-    else:
-        exit("Socket API not available: enable it via...\n  management api http-commands\n    protocol unix-socket\n    no shutdown")
+    ### Build connection to api, the handle is kept for the life of the script
+    ### main() has already checked that the socket exists
+    global _switch_api
+    if _switch_api is None:
+        _switch_api = Server( "unix:" + apiSocket)
+    return _switch_api
 #
 
 def main():
     global args
-    dampeningDead = 0
-    dampeningAlive = 0
-    wasAlive = True
 
     args = parseArgs()
     setLogging(args)
     argsDisplay(args)
-    osSettings = checkOS()
-    net31 = network_s31(args.host[0])
-    logging.debug(logStr.format('network /31 for host:', net31))
-    filtered, seqno = check_filter(net31, prefix_list_name)
-    if filtered:
-        if wasAlive:
-            logging.info(logStr.format('Target already filtered ', prefix_list_name))
-            wasAlive = False
 
+    # Fail fast on bad input or a missing API rather than in the poll loop
+    ips = []
+    for host in args.host:
+        ip = parse_address(host)
+        if ip in ips:
+            logging.info('Target %s given more than once', host)
+            continue
+        ips.append(ip)
+    # Hosts are kept in the address format recvfrom() reports replies with
+    args.host = [str(ip) for ip in ips]
+    if not os.path.exists(apiSocket):
+        sys.exit("Socket API not available: enable it via...\n  management api http-commands\n    protocol unix-socket\n    no shutdown")
+
+    # The ICMP socket is opened before touching the prefix-list
+    if args.mode == 'icmp':
+        check = checkICMP(args.host)
+
+    # Per host state, indexed like args.host: net /31 and dampening counters
+    nets = [network_s31(ip) for ip in ips]
+    dampeningDead = [0] * len(args.host)
+    dampeningAlive = [0] * len(args.host)
+    wasAlive = [True] * len(args.host)
+    load_filters(nets, prefix_list_name)
+    for i, host in enumerate(args.host):
+        net31 = nets[i]
+        logging.debug(logStr, 'network /31 for host:', net31)
+        if check_filter(net31, prefix_list_name):
+            logging.info('Target %s already filtered in %s', host,
+                         prefix_list_name)
+            wasAlive[i] = False
+
+    send = Notice()
     try:
         while True:
-            if args.mode == 'icmp':
-                check = checkICMP(osSettings, args.host[0])
+            # Polls start on a fixed cadence, however long the checks take
+            nextPoll = time.monotonic() + args.interval
 
-            # Check alive (True/False) and response (ICMP latency)
+            # Check alive (True/False) and response (ICMP latency) of all hosts
             alive, response = check.isAlive()
 
-            send = Notice()
-            if alive:
-                logging.info(logStr.format('Target alive. Response:', response))
-                # Dead dampening count re-initializing
-                dampeningDead = 0
-
-                if not wasAlive:
+            for i, host in enumerate(args.host):
+                net31 = nets[i]
+                if alive[i]:
+                    logging.info('Target %s alive. Response: %.3f ms', host,
+                                 response[i])
+
+                # Failures in a row, and successes in a row since the
+                # target was found dead. Each resets the other.
+                dampeningDead[i] = 0 if alive[i] else dampeningDead[i] + 1
+                dampeningAlive[i] = min(dampeningAlive[i] + 1, args.dampening) \
+                    if alive[i] and not wasAlive[i] else 0
+
+                # Only a successful probe can resurrect a target and only a
+                # failed one can kill it, which matters with -D 0
+                if alive[i] and not wasAlive[i] and \
+                        dampeningAlive[i] == args.dampening:
+                    # The dampening is completed, target considered resurrected
+                    wasAlive[i] = True
+                    dampeningAlive[i] = 0
+                    logging.error('Target %s resurrected!', host)
+                    send.syslog('Target %s is available', host)
+                    # remove filter if in place
+                    ### Insert extra code here for further verifacation service is up steps
+                    if check_and_remove(net31, prefix_list_name):
+                        logging.error('Target %s removed from prefix-list: %s', host,
+                                      prefix_list_name)
+                        send.syslog('Target %s removed from %s prefix-list',
+                                    host, prefix_list_name)
+                elif dampeningAlive[i]:
                     # Was dead, is now coming back to life. Dampening kicks in.
-                    if (dampeningAlive < args.dampening):
-                        dampeningAlive += 1
-                        logging.info('Dampening in progress')
-                        logging.debug(logStr.format(
-                            'Remaining successes before assuming resurrection:',
-                            dampeningAlive))
-                    elif (dampeningAlive == args.dampening):
-                        # The dampening is completed, target considered resurrected
-                        wasAlive = True
-                        dampeningAlive = 0
-                        logging.error('Target resurrected!')
-                        send.syslog('Target {} is available'.format(
-                                    args.host[0], args.mode))
-                        # remove filter if in place
-                        ### Insert extra code here for further verifacation service is up steps
-                        filtered, seqno = check_filter(net31, prefix_list_name)
-                        if filtered:
-                            remove_filter(seqno, prefix_list_name)
-                            logging.error(logStr.format('Target removed from prefix-list:', prefix_list_name))
-                            send.syslog('Target {} removed from {} prefix-list'.format(
-                                    args.host[0], prefix_list_name))
-
-            else:
-                # Looks like dead. Dampening in progress
-                dampeningDead += 1
-                # Alive dampening count re-initializing
-                dampeningAlive = 0
-
-                if wasAlive and (dampeningDead >= args.dampening):
-                    logging.error(logStr.format('Warning:', 'Target is dead'))
-                    send.syslog('Target {} is dead - added to {} prefix-list'.format(
-                                args.host[0], prefix_list_name))
+                    logging.info('Target %s dampening in progress', host)
+                    logging.debug(logStr,
+                        'Remaining successes before assuming resurrection:',
+                        args.dampening - dampeningAlive[i])
+
+                # Looks like dead. Dampening at failure is silent (intuitive enough?)
+                if not alive[i] and wasAlive[i] and \
+                        dampeningDead[i] >= args.dampening:
+                    logging.error(logStr, 'Warning:', 'Target %s is dead' % host)
+                    send.syslog('Target %s is dead - added to %s prefix-list',
+                                host, prefix_list_name)
                     ### Insert extra code here for further verifacation service is down steps
                     # Set filter
                     add_filter(net31, prefix_list_name)
 
                     # Death tracker
-                    wasAlive = False
-                else:
-                    # Either the target is already dead or Dampening is going on
-                    # Dampening at failure is silent (intuitive enough?)
-                    pass
+                    wasAlive[i] = False
+
             logging.debug('')
-            time.sleep(args.interval)
+            pause = nextPoll - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
     except KeyboardInterrupt:
         print(' Interrupted! Exiting...')
 